@@ -1,43 +1,253 @@
+from collections import OrderedDict
 import lmdb
+import lz4.block
+import math
+import queue
+import struct
+import threading
+import time
 import torch
-from safetensors.torch import load, save
 from typing import Union
-import hashlib
+import xxhash
+
+from mii.logging import logger
+
+# dtype codes written into the serialized header, append only
+_DTYPES = [
+    torch.bfloat16,
+    torch.float16,
+    torch.float32,
+    torch.int64,
+    torch.int32,
+    torch.uint8
+]
+# header flag bits
+_LZ4_COMPRESSED = 1
+# write queue sentinels
+_FLUSH = object()
+_CLOSE = object()
+
 
 class StorageBackend:
-    def __init__(self, max_storage_size, path, chunk_size):
+    def __init__(self,
+                 max_storage_size,
+                 path,
+                 chunk_size,
+                 max_memory_size=64 << 20,
+                 compress=False,
+                 flush_batch_size=64,
+                 flush_interval_ms=5,
+                 max_pending_writes=64):
         self.chunk_size = chunk_size
-        self.env = lmdb.open(path, map_size=max_storage_size)
-        
+        self.env = lmdb.open(path,
+                             map_size=max_storage_size,
+                             writemap=True,
+                             map_async=True,
+                             metasync=False,
+                             sync=False)
+        self.compress = compress
+        self.max_memory_size = max_memory_size
+        self.mem_cache = OrderedDict()
+        self._mem_bytes = 0
+        self._pin_memory = torch.cuda.is_available()
+        self._mem_lock = threading.Lock()
+        self._d2h_stream = None
+        self._fixed_header = None
+        self.flush_batch_size = flush_batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self._write_queue = queue.Queue(maxsize=max_pending_writes)
+        self._map_full = False
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def _mem_put(self, hashed_key: bytes, value: torch.Tensor):
+        nbytes = value.numel() * value.element_size()
+        if nbytes > self.max_memory_size:
+            return
+        if value.device.type != "cpu" or (
+                self._pin_memory and not value.is_pinned()) or not value.is_contiguous():
+            value = torch.empty(value.shape,
+                                dtype=value.dtype,
+                                pin_memory=self._pin_memory).copy_(value)
+        with self._mem_lock:
+            if hashed_key in self.mem_cache:
+                self.mem_cache.move_to_end(hashed_key)
+                return
+            self.mem_cache[hashed_key] = value
+            self._mem_bytes += nbytes
+            while self._mem_bytes > self.max_memory_size:
+                _, evicted = self.mem_cache.popitem(last=False)
+                self._mem_bytes -= evicted.numel() * evicted.element_size()
+
+    def _mem_get(self, hashed_key: bytes):
+        with self._mem_lock:
+            value = self.mem_cache.get(hashed_key)
+            if value is not None:
+                self.mem_cache.move_to_end(hashed_key)
+            return value
+
+    def stage(self, values: list[torch.Tensor]):
+        for value in values:
+            assert value.dim() == 3 and value.shape[1] == self.chunk_size, \
+                f"expected (layers, {self.chunk_size}, hidden), got {tuple(value.shape)}"
+            assert value.dtype in _DTYPES, f"unsupported latent dtype {value.dtype}"
+        staged = []
+        for value in values:
+            if value.device.type == "cpu":
+                staged.append((value, None))
+                continue
+            if self._d2h_stream is None:
+                self._d2h_stream = torch.cuda.Stream(device=value.device)
+            self._d2h_stream.wait_stream(torch.cuda.current_stream(value.device))
+            with torch.cuda.stream(self._d2h_stream):
+                staged_value = torch.empty(value.shape,
+                                           dtype=value.dtype,
+                                           pin_memory=True).copy_(value,
+                                                                  non_blocking=True)
+                copied = torch.cuda.Event()
+                copied.record()
+            # value may be freed before the copy lands, keep its memory alive until then
+            value.record_stream(self._d2h_stream)
+            staged.append((staged_value, copied))
+        return staged
+
     def _serialize(self, latent: torch.Tensor):
-        return save({"latent_bytes": latent.contiguous()})
-
-    def _deserialize(self, b: Union[bytearray, bytes]):
-        return load(bytes(b))["latent_bytes"]
-
-    def _hashing(self, input_token_chunk: torch.Tensor):
-        # assert input_token_chunk.shape[0]
-        return hashlib.sha256(input_token_chunk.cpu().numpy().tobytes()).hexdigest()
-    
-    def put(self, key: torch.Tensor, value: torch.Tensor):
-        hashed_key = self._hashing(key)
-        serialized_value = self._serialize(value)
-        with self.env.begin(write=True) as txn:
-            txn.put(hashed_key.encode(), serialized_value)
-
-    def get(self, key: torch.Tensor):
-        hashed_key = self._hashing(key)
-        with self.env.begin() as txn:
-            value = txn.get(hashed_key.encode())
-            if value:
-                return self._deserialize(value)
-            else:
+        latent = latent.detach().contiguous().cpu()
+        payload = memoryview(latent.view(torch.uint8).numpy())
+        flags = 0
+        if self.compress:
+            payload = lz4.block.compress(payload,
+                                         mode="fast",
+                                         acceleration=8,
+                                         store_size=False)
+            flags |= _LZ4_COMPRESSED
+        header = struct.pack(f"<BBB5x{latent.dim()}q",
+                             _DTYPES.index(latent.dtype),
+                             latent.dim(),
+                             flags,
+                             *latent.shape)
+        return b"".join([header, payload])
+
+    def _header(self, b: Union[bytearray, bytes, memoryview]):
+        fixed = self._fixed_header
+        if fixed is not None and b[0:len(fixed[0])] == fixed[0]:
+            return fixed[1]
+        dtype_code, ndim, flags = struct.unpack_from("<BBB", b)
+        dtype, offset = _DTYPES[dtype_code], 8 + 8 * ndim
+        shape = struct.unpack_from(f"<{ndim}q", b, 8)
+        meta = (dtype,
+                shape,
+                offset,
+                flags,
+                math.prod(shape) * torch.empty(0,
+                                               dtype=dtype).element_size())
+        self._fixed_header = (bytes(b[0:offset]), meta)
+        return meta
+
+    def _deserialize(self, b: Union[bytearray, bytes, memoryview]):
+        dtype, shape, offset, flags, nbytes = self._header(b)
+        out = torch.empty(shape, dtype=dtype, pin_memory=self._pin_memory)
+        if flags & _LZ4_COMPRESSED:
+            buf = lz4.block.decompress(memoryview(b)[offset:],
+                                       uncompressed_size=nbytes,
+                                       return_bytearray=True)
+            return out.copy_(torch.frombuffer(buf, dtype=dtype).view(shape))
+        memoryview(out.view(-1).view(torch.uint8).numpy())[:] = memoryview(b)[offset:]
+        return out
+
+    def new_hasher(self):
+        return xxhash.xxh3_64()
+
+    def prefix_hashes(self, seq: torch.Tensor, start_chunk: int = 0):
+        seq_bytes = memoryview(seq.contiguous().numpy()).cast("B")
+        chunk_bytes = self.chunk_size * seq.element_size()
+        hasher = self.new_hasher()
+        hasher.update(seq_bytes[0:start_chunk * chunk_bytes])
+        hashed_keys = []
+        for i in range(start_chunk, seq.shape[0] // self.chunk_size):
+            hasher.update(seq_bytes[i * chunk_bytes:(i + 1) * chunk_bytes])
+            hashed_keys.append(hasher.digest())
+        return hashed_keys
+
+    def gather(self, hashed_keys: list[bytes]):
+        with self.env.begin(buffers=True) as txn:
+            hits = []
+            for hashed_key in hashed_keys:
+                value = self._mem_get(hashed_key)
+                if value is None:
+                    value = txn.get(hashed_key)
+                # prefixes are nested, so every key after the first miss misses too
+                if value is None:
+                    break
+                hits.append((hashed_key, value))
+            if not len(hits):
                 return None
-            
-
-    def batch_put(self, keys: list[torch.Tensor], values: list[torch.Tensor]):
-        with self.env.begin(write=True) as txn:
-            for key, value in zip(keys, values):
-                hashed_key = self._hashing(key)
-                serialized_value = self._serialize(value)
-                txn.put(hashed_key.encode(), serialized_value)
\ No newline at end of file
+            first = hits[0][1]
+            if isinstance(first, torch.Tensor):
+                dtype, shape = first.dtype, first.shape
+            else:
+                dtype, shape, _, _, _ = self._header(first)
+            out = torch.empty((shape[0], shape[1] * len(hits), *shape[2:]), dtype=dtype)
+            for i, (hashed_key, value) in enumerate(hits):
+                slot = out[:, i * shape[1]:(i + 1) * shape[1]]
+                if not isinstance(value, torch.Tensor):
+                    value = self._deserialize(value)
+                    self._mem_put(hashed_key, value)
+                slot.copy_(value)
+        return out
+
+    def batch_put_staged(self, hashed_keys: list[bytes], staged: list):
+        for hashed_key, (value, copied) in zip(hashed_keys, staged):
+            if copied is not None:
+                copied.synchronize()
+            # the memory tier is filled by the flusher only after the commit, so every
+            # rank sees the same hits
+            self._write_queue.put((hashed_key, value))
+
+    def _flush_loop(self):
+        while True:
+            items = []
+            item = self._write_queue.get()
+            got = 1
+            deadline = time.monotonic() + self.flush_interval
+            while item is not _FLUSH and item is not _CLOSE:
+                items.append(item)
+                timeout = deadline - time.monotonic()
+                if len(items) >= self.flush_batch_size or timeout <= 0:
+                    break
+                try:
+                    item = self._write_queue.get(timeout=timeout)
+                    got += 1
+                except queue.Empty:
+                    break
+            try:
+                if len(items) and not self._map_full:
+                    serialized = [(hashed_key,
+                                   self._serialize(value)) for hashed_key,
+                                  value in items]
+                    with self.env.begin(write=True) as txn:
+                        txn.cursor().putmulti(serialized, dupdata=False, overwrite=False)
+                    for hashed_key, value in items:
+                        self._mem_put(hashed_key, value)
+            except lmdb.MapFullError:
+                self._map_full = True
+                logger.warning(
+                    f"lmdb map is full ({self.env.info()['map_size']} bytes), "
+                    "latent chunks will no longer be stored")
+            except Exception as e:
+                logger.warning(
+                    f"dropping {len(items)} latent chunks, lmdb write failed: {e}")
+            finally:
+                for _ in range(got):
+                    self._write_queue.task_done()
+            if item is _CLOSE:
+                return
+
+    def flush(self):
+        self._write_queue.put(_FLUSH)
+        self._write_queue.join()
+
+    def close(self):
+        self._write_queue.put(_CLOSE)
+        self._flusher.join()
+        self.env.close()
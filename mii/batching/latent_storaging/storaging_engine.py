@@ -1,33 +1,62 @@
+from concurrent.futures import ThreadPoolExecutor, wait
 from .storage_backend import StorageBackend
 import torch
 
+from mii.logging import logger
+
+
 class LatentStoragingEngie:
-    def __init__(self, chunk_size):
+    def __init__(self,
+                 chunk_size,
+                 compress=False,
+                 max_memory_size=64 << 20,
+                 storage_path='/home/zzy/storage_path'):
         self.chunk_size = chunk_size
-        self.backend = StorageBackend(160000000, '/home/zzy/storage_path', chunk_size)
+        self.backend = StorageBackend(160000000,
+                                      storage_path,
+                                      chunk_size,
+                                      max_memory_size=max_memory_size,
+                                      compress=compress)
+        self._exec = ThreadPoolExecutor(max_workers=1)
+        self._last_store = None
 
     def retrive(self, seq: torch.Tensor):
-        retrived_list = []
+        seq = seq.cpu()
         # print(f"seq len: {seq.shape[0]}")
-        for i in range(seq.shape[0] // self.chunk_size):
-            chunked_seq = seq[0: (i + 1) * self.chunk_size]
-            stored = self.backend.get(chunked_seq)
-            if not stored == None:
-                retrived_list.append(stored)
-        if len(retrived_list):
-            retrived = torch.concat(retrived_list, dim=1)
-            return retrived
-        else:
-            return None
-    
+        hashed_keys = self.backend.prefix_hashes(seq)
+        return self.backend.gather(hashed_keys)
+
     def store_seq(self, seq: torch.Tensor, value: torch.Tensor, restored_offset: int):
-        seq_len = seq.shape[0]
-        chunk_num = seq_len // self.chunk_size
+        seq = seq.cpu()
         chunk_offset = restored_offset // self.chunk_size
-        chunked_seq = []
-        chunked_value = []
-        for i in range(chunk_num - chunk_offset):
-            chunked_seq.append(seq[0: (i + chunk_offset + 1) * self.chunk_size])
-            chunked_value.append(value[:, i * self.chunk_size: (i + 1) * self.chunk_size])
-        if len(chunked_seq):
-            self.backend.batch_put(chunked_seq, chunked_value)
+        chunk_num = min(seq.shape[0] // self.chunk_size - chunk_offset,
+                        value.shape[1] // self.chunk_size)
+        if chunk_num <= 0:
+            return
+        staged = self.backend.stage([
+            value[:,
+                  i * self.chunk_size:(i + 1) * self.chunk_size]
+            for i in range(chunk_num)
+        ])
+        self._last_store = self._exec.submit(self._do_store, seq, staged, chunk_offset)
+        self._last_store.add_done_callback(self._log_store_error)
+
+    def _do_store(self, seq: torch.Tensor, staged: list, chunk_offset: int):
+        hashed_keys = self.backend.prefix_hashes(seq, chunk_offset)[0:len(staged)]
+        self.backend.batch_put_staged(hashed_keys, staged)
+
+    def _log_store_error(self, future):
+        if future.exception() is not None:
+            logger.warning(f"failed to store latents: {future.exception()}")
+
+    def flush(self):
+        if self._last_store is None:
+            return
+        wait([self._last_store])
+        self._last_store = None
+        self.backend.flush()
+
+    def close(self):
+        self.flush()
+        self._exec.shutdown()
+        self.backend.close()
@@ -79,9 +79,13 @@ class RaggedBatchBase:
         self._iters: int = 0
         self._num_generated_tokens: int = 0
         self.storaging_chunk_size = 4
+        self.storaging_compress = False
+        self.storaging_memory_size = 64 << 20
         self.model_size = 4096
         self.model_layer_num = 32
-        self.storage_engine = storaging_engine.LatentStoragingEngie(self.storaging_chunk_size)
+        self.storage_engine = storaging_engine.LatentStoragingEngie(self.storaging_chunk_size,
+                                                                    self.storaging_compress,
+                                                                    self.storaging_memory_size)
 
         # Use ZMQ because it is light-weight and fast for passing simple
         # messages (i.e., token sequences) between each TP process of the
@@ -112,6 +116,10 @@ class RaggedBatchBase:
         This is the main loop of FastGen: puts requests and gets generated results.
         """
 
+        # 0. Commit latents stored by rank 0 last step, so every rank sees the same storage hits in step 3
+        if self.is_rank_0:
+            self.storage_engine.flush()
+
         # 1. Get a batch of requests, broadcast to all ranks
         scheduled_requests, force = self._bcast_requests()
 
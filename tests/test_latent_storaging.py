@@ -0,0 +1,124 @@
+# Copyright (c) Microsoft Corporation.
+# SPDX-License-Identifier: Apache-2.0
+
+# DeepSpeed Team
+import pytest
+import torch
+import xxhash
+
+from mii.batching.latent_storaging.storage_backend import StorageBackend, _DTYPES
+from mii.batching.latent_storaging.storaging_engine import LatentStoragingEngie
+
+CHUNK_SIZE = 4
+
+
+@pytest.fixture
+def make_backend(tmp_path):
+    backends = []
+
+    def _make_backend(**kwargs):
+        backend = StorageBackend(1 << 26,
+                                 str(tmp_path / str(len(backends))),
+                                 CHUNK_SIZE,
+                                 **kwargs)
+        backends.append(backend)
+        return backend
+
+    yield _make_backend
+    for backend in backends:
+        backend.close()
+
+
+@pytest.fixture
+def backend(make_backend):
+    return make_backend()
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = LatentStoragingEngie(CHUNK_SIZE, storage_path=str(tmp_path))
+    yield engine
+    engine.close()
+
+
+def make_chunk(dtype, layers=2, hidden=8, tokens=CHUNK_SIZE):
+    if dtype.is_floating_point:
+        return torch.randn(layers, tokens, hidden).to(dtype)
+    return torch.randint(0, 100, (layers, tokens, hidden), dtype=dtype)
+
+
+def store(backend, hashed_keys, values):
+    backend.batch_put_staged(hashed_keys, backend.stage(values))
+    backend.flush()
+
+
+@pytest.mark.parametrize("compress", [False, True], ids=["raw", "lz4"])
+@pytest.mark.parametrize("dtype", _DTYPES, ids=[str(d).split(".")[-1] for d in _DTYPES])
+def test_serialize_round_trip(make_backend, dtype, compress):
+    backend = make_backend(compress=compress)
+    latent = make_chunk(dtype)
+    b = backend._serialize(latent)
+
+    restored = backend._deserialize(memoryview(b))
+    assert restored.dtype == dtype
+    assert restored.is_contiguous()
+    assert torch.equal(restored, latent)
+
+
+def test_prefix_hashes(backend):
+    seq = torch.arange(5 * CHUNK_SIZE + 2)
+    hashed_keys = backend.prefix_hashes(seq)
+    assert len(hashed_keys) == 5
+    for i, hashed_key in enumerate(hashed_keys):
+        prefix = seq[0:(i + 1) * CHUNK_SIZE].numpy().tobytes()
+        assert hashed_key == xxhash.xxh3_64_digest(prefix)
+    for start_chunk in range(6):
+        assert backend.prefix_hashes(seq, start_chunk) == hashed_keys[start_chunk:]
+
+
+def test_lru_evicts_by_bytes(make_backend):
+    chunk_bytes = 2 * CHUNK_SIZE * 8 * 4
+    backend = make_backend(max_memory_size=2 * chunk_bytes + chunk_bytes // 2)
+    backend._mem_put(b"a", make_chunk(torch.float32))
+    backend._mem_put(b"b", make_chunk(torch.float32))
+    assert backend._mem_get(b"a") is not None
+    backend._mem_put(b"c", make_chunk(torch.float32))
+    assert list(backend.mem_cache.keys()) == [b"a", b"c"]
+    assert backend._mem_bytes == 2 * chunk_bytes
+
+
+@pytest.mark.parametrize("from_lmdb", [False, True], ids=["memory", "lmdb"])
+def test_gather_stops_at_first_miss(backend, from_lmdb):
+    hashed_keys = backend.prefix_hashes(torch.arange(5 * CHUNK_SIZE))
+    values = [make_chunk(torch.bfloat16) for _ in hashed_keys]
+    # chunk 2 is missing, so the stored chunks 3 and 4 must not be returned
+    stored = [0, 1, 3, 4]
+    store(backend, [hashed_keys[i] for i in stored], [values[i] for i in stored])
+    if from_lmdb:
+        backend.mem_cache.clear()
+        backend._mem_bytes = 0
+
+    gathered = backend.gather(hashed_keys)
+    assert torch.equal(gathered, torch.concat(values[0:2], dim=1))
+    assert backend.gather(hashed_keys[2:]) is None
+
+
+def test_engine_store_and_retrive(engine):
+    seq = torch.arange(5 * CHUNK_SIZE + 2)
+    latents = make_chunk(torch.bfloat16, tokens=seq.shape[0])
+    assert engine.retrive(seq) is None
+
+    # the trailing partial chunk is not stored
+    engine.store_seq(seq[0:2 * CHUNK_SIZE + 2], latents[:, 0:2 * CHUNK_SIZE + 2], 0)
+    engine.flush()
+    assert torch.equal(engine.retrive(seq), latents[:, 0:2 * CHUNK_SIZE])
+
+    # value starts at restored_offset and is keyed by the prefix up to each of its chunks
+    engine.store_seq(seq, latents[:, 2 * CHUNK_SIZE:], 2 * CHUNK_SIZE)
+    # fewer latents than tokens, only the chunks value covers are stored
+    other_seq = torch.arange(100, 100 + 4 * CHUNK_SIZE)
+    other_latents = make_chunk(torch.bfloat16, tokens=CHUNK_SIZE + 2)
+    engine.store_seq(other_seq, other_latents, 0)
+    engine.flush()
+    assert torch.equal(engine.retrive(seq), latents[:, 0:5 * CHUNK_SIZE])
+    assert torch.equal(engine.retrive(other_seq), other_latents[:, 0:CHUNK_SIZE])